@@ -6,14 +6,31 @@ This script analyzes Azure VM CPU utilization and provides right-sizing recommen
 for underutilized VMs to optimize cost.
 """
 
+import os
 import sys
+import csv
+import json
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.monitor import MonitorManagementClient
-from azure.mgmt.resource import SubscriptionClient
+import time
+import random
+import sqlite3
+import argparse
+from collections import defaultdict
+from operator import itemgetter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from azure.identity.aio import DefaultAzureCredential
+from azure.mgmt.resource.subscriptions.aio import SubscriptionClient
+from azure.mgmt.resourcegraph.aio import ResourceGraphClient
+from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
+from azure.monitor.query import MetricAggregationType
+from azure.monitor.query.aio import MetricsClient
 from azure.core.exceptions import HttpResponseError, ClientAuthenticationError
+from azure.core.pipeline.policies import AsyncRetryPolicy
 from tabulate import tabulate
 
 # Configure logging
@@ -27,36 +44,114 @@ logger = logging.getLogger(__name__)
 # Configuration
 CPU_THRESHOLD = 30  # CPU percentage threshold for considering a VM underutilized
 DAYS_TO_ANALYZE = 7  # Number of days of metrics to analyze
+METRICS_GRANULARITY = timedelta(days=1)  # Metric time grain; coarser grains shrink the metrics payload
+METRICS_BATCH_SIZE = 50  # Maximum number of resource IDs per metrics:getBatch request
+METRICS_ENDPOINT = "https://{region}.metrics.monitor.azure.com"  # Regional metrics data-plane endpoint
+METRICS_INGESTION_DELAY = timedelta(hours=1)  # Time after an interval ends before its metrics are treated as final
+DEFAULT_MAX_CONCURRENCY = 32  # Concurrent metrics requests; lower this if requests are throttled (HTTP 429)
+RESOURCE_GRAPH_PAGE_SIZE = 1000  # Maximum rows per Resource Graph page
+MANAGEMENT_SCOPE = "https://management.azure.com/.default"  # Token scope for Azure Resource Manager
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".vm_rightsizing_cache.sqlite")  # On-disk cache location
+INVENTORY_CACHE_TTL = timedelta(hours=1)  # How long a cached VM inventory is reused
+MAX_TABLE_ROWS = 50  # Largest result printed as a grid table; larger or piped results are written as CSV
+PARQUET_PATH = "vm_rightsizing_recommendations.parquet"  # Machine-readable recommendations output
 
+# Retry settings for every Azure client; throttled (HTTP 429) and transient 5xx responses are retried,
+# including on the POST queries used by Resource Graph and metrics:getBatch, honouring Retry-After
+# when the service sends it
+RETRY_SETTINGS = {
+    "retry_total": 10,  # Maximum number of retries per request
+    "retry_status": 10,  # Maximum number of retries on retryable status codes
+    "retry_backoff_factor": 1.5,  # Base delay in seconds for exponential backoff
+    "retry_backoff_max": 60,  # Upper bound in seconds for a single retry delay
+}
 
-def authenticate_azure():
+# Columns of the recommendations table, as printed and as written to Parquet
+RECOMMENDATIONS_SCHEMA = pa.schema([
+    ("VM Name", pa.string()),
+    ("Resource Group", pa.string()),
+    ("Location", pa.string()),
+    ("VM Size", pa.string()),
+    ("Avg CPU (%)", pa.float64()),
+    ("Max CPU (%)", pa.float64()),
+    ("Recommendation", pa.string()),
+])
+
+# Resource Graph query returning every VM with its size and power state in one paginated response
+VM_QUERY = (
+    "Resources"
+    " | where type =~ 'microsoft.compute/virtualMachines'"
+    " | project id, name, resourceGroup, location,"
+    " vmSize = tostring(properties.hardwareProfile.vmSize),"
+    " powerState = tostring(split(properties.extended.instanceView.powerState.code, '/')[1])"
+)
+
+
+class JitteredRetryPolicy(AsyncRetryPolicy):
     """
-    Authenticate with Azure using DefaultAzureCredential.
-    Returns the credential object or exits if authentication fails.
+    Azure SDK retry policy adjusted for the read-only queries this script sends.
+    POST is added to the retryable methods, since Resource Graph and metrics:getBatch queries
+    are POST requests that are safe to repeat; by default azure-core retries POST only on
+    500, 503 and 504, so a throttled (HTTP 429) query without Retry-After would fail.
+    The exponential backoff is also randomized, so requests that were throttled together
+    don't all retry at the same moment.
     """
-    try:
-        logger.info("Authenticating with Azure...")
-        credential = DefaultAzureCredential()
-        # Test the credential with a small operation
-        subscription_client = SubscriptionClient(credential)
-        subscription_client.subscriptions.list(top=1)
-        logger.info("Authentication successful")
-        return credential
-    except ClientAuthenticationError as e:
-        logger.error(f"Authentication failed: {str(e)}")
-        logger.error("Please ensure you are logged in (az login) or have appropriate environment variables set")
-        sys.exit(1)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._method_whitelist = self._method_whitelist | {"POST"}
+    
+    def get_backoff_time(self, settings):
+        # Cap after jittering, so no delay exceeds retry_backoff_max
+        return min(settings["max_backoff"], super().get_backoff_time(settings) * random.uniform(0.5, 1.5))
+
+
+def wait_for_quota(pipeline_response):
+    """
+    Response hook for the Resource Graph client that pauses until the per-user query quota
+    resets once it has been used up. Resource Graph pages are fetched one at a time before
+    any metrics are requested, so blocking the event loop here only holds back the next page.
+    """
+    headers = pipeline_response.http_response.headers
+    resets_after = headers.get("x-ms-user-quota-resets-after")
+    if headers.get("x-ms-user-quota-remaining") == "0" and resets_after:
+        hours, minutes, seconds = resets_after.split(":")
+        delay = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        logger.warning(f"Resource Graph quota exhausted, pausing for {delay:.0f}s")
+        time.sleep(delay)
+
+
+@dataclass
+class AzureClients:
+    """
+    Azure SDK clients shared by all API calls in a run.
+    Built once after subscription selection so every call, including the metrics queries,
+    reuses the same credential and token cache.
+    """
+    credential: DefaultAzureCredential
+    subscription_id: str
+    resource_graph_client: ResourceGraphClient
 
 
-def get_subscription(credential, subscription_id=None):
+async def authenticate_azure(credential):
+    """
+    Authenticate with Azure using the given DefaultAzureCredential.
+    Raises ClientAuthenticationError if authentication fails.
+    """
+    logger.info("Authenticating with Azure...")
+    # Acquire a management token up front; this validates the credential, resolves the
+    # credential chain once for the whole run, and caches the token so the first API call
+    # doesn't pay the authentication latency
+    await credential.get_token(MANAGEMENT_SCOPE)
+    logger.info("Authentication successful")
+
+
+async def get_subscription(subscription_client, subscription_id=None):
     """
     Get the subscription to use. If subscription_id is provided, use that.
     Otherwise, list available subscriptions and let the user choose.
     """
-    subscription_client = SubscriptionClient(credential)
-    
     try:
-        subscriptions = list(subscription_client.subscriptions.list())
+        subscriptions = [sub async for sub in subscription_client.subscriptions.list()]
         
         if not subscriptions:
             logger.error("No subscriptions found for the authenticated account")
@@ -77,11 +172,13 @@ def get_subscription(credential, subscription_id=None):
             return subscription.subscription_id
         else:
             # Let the user choose from available subscriptions
-            print("\nAvailable subscriptions:")
+            report = report_stream()
+            print("\nAvailable subscriptions:", file=report)
             for i, sub in enumerate(subscriptions):
-                print(f"{i+1}. {sub.display_name} ({sub.subscription_id})")
+                print(f"{i+1}. {sub.display_name} ({sub.subscription_id})", file=report)
             
-            choice = input("\nSelect a subscription (number): ")
+            print("\nSelect a subscription (number): ", end="", file=report, flush=True)
+            choice = input()
             try:
                 index = int(choice) - 1
                 if 0 <= index < len(subscriptions):
@@ -94,228 +191,555 @@ def get_subscription(credential, subscription_id=None):
             except ValueError:
                 logger.error("Invalid input, please enter a number")
                 sys.exit(1)
+    except ClientAuthenticationError:
+        raise
     except HttpResponseError as e:
         logger.error(f"Error listing subscriptions: {str(e)}")
         sys.exit(1)
 
 
-def get_virtual_machines(credential, subscription_id):
+async def iter_vm_rows(clients):
+    """
+    Yield Resource Graph rows for every VM in the subscription.
+    Pages are fetched lazily, so rows from one page are processed before the next page is requested.
+    """
+    skip_token = None
+    while True:
+        response = await clients.resource_graph_client.resources(QueryRequest(
+            subscriptions=[clients.subscription_id],
+            query=VM_QUERY,
+            options=QueryRequestOptions(top=RESOURCE_GRAPH_PAGE_SIZE, skip_token=skip_token)
+        ))
+        for row in response.data:
+            yield row
+        skip_token = response.skip_token
+        if not skip_token:
+            break
+
+
+async def get_virtual_machines(clients, cache=None):
     """
     Retrieve all virtual machines in the subscription.
     Returns a list of VMs with their details, including power state.
+    Uses a single paginated Azure Resource Graph query instead of per-VM instance view calls.
+    If a cache is given, a VM list cached within INVENTORY_CACHE_TTL is returned instead.
     """
+    if cache is not None:
+        vm_list = load_cached_inventory(cache, clients.subscription_id)
+        if vm_list is not None:
+            logger.info(f"Using cached inventory of {len(vm_list)} virtual machines")
+            return vm_list
+    
     try:
         logger.info("Retrieving virtual machines...")
-        compute_client = ComputeManagementClient(credential, subscription_id)
-        vms = compute_client.virtual_machines.list_all()
-        
         vm_list = []
         running_vms = []
         stopped_vms = []
         
-        for vm in vms:
-            resource_group = vm.id.split("/")[4]
-            
-            # Get VM instance view to check power state
-            instance_view = compute_client.virtual_machines.instance_view(
-                resource_group_name=resource_group,
-                vm_name=vm.name
-            )
-            
-            # Extract power state from status
-            power_state = "unknown"
-            for status in instance_view.statuses:
-                if status.code.startswith("PowerState/"):
-                    power_state = status.code.split("/")[1].lower()
-                    break
+        async for row in iter_vm_rows(clients):
+            name = row["name"]
+            power_state = row["powerState"].lower() or "unknown"
             
             vm_info = {
-                "name": vm.name,
-                "resource_group": resource_group,
-                "location": vm.location,
-                "vm_size": vm.hardware_profile.vm_size if hasattr(vm.hardware_profile, 'vm_size') else "Unknown",
-                "id": vm.id,
+                "name": name,
+                "resource_group": row["resourceGroup"],
+                "location": row["location"],
+                "vm_size": row["vmSize"] or "Unknown",
+                "id": row["id"],
                 "power_state": power_state
             }
             
             vm_list.append(vm_info)
             
             if power_state == "running":
-                running_vms.append(vm.name)
+                running_vms.append(name)
             elif power_state in ["stopped", "deallocated"]:
-                stopped_vms.append(vm.name)
+                stopped_vms.append(name)
         
         logger.info(f"Found {len(vm_list)} virtual machines total")
         logger.info(f"Running VMs: {len(running_vms)} - {', '.join(running_vms) if running_vms else 'None'}")
         logger.info(f"Stopped/Deallocated VMs: {len(stopped_vms)} - {', '.join(stopped_vms) if stopped_vms else 'None'}")
         
+        if cache is not None:
+            save_cached_inventory(cache, clients.subscription_id, vm_list)
         return vm_list
+    except ClientAuthenticationError:
+        raise
     except HttpResponseError as e:
         logger.error(f"Error retrieving virtual machines: {str(e)}")
         sys.exit(1)
 
 
-def get_cpu_utilization(monitor_client, vm, subscription_id, start_time, end_time):
+def open_cache(path=CACHE_PATH):
     """
-    Get CPU utilization metrics for a VM over the specified time period.
+    Open the on-disk cache, creating its tables if needed.
+    Metrics are stored per VM and METRICS_GRANULARITY interval; the VM inventory is stored per subscription.
     """
-    try:
-        logger.debug(f"Retrieving CPU metrics for VM: {vm['name']}")
-        resource_uri = f"/subscriptions/{subscription_id}/resourceGroups/{vm['resource_group']}/providers/Microsoft.Compute/virtualMachines/{vm['name']}"
-        
-        metrics_data = monitor_client.metrics.list(
-            resource_uri=resource_uri,
-            timespan=f"{start_time.isoformat()}Z/{end_time.isoformat()}Z",
-            interval='PT1H',
-            metricnames='Percentage CPU',
-            aggregation='Average'
+    cache = sqlite3.connect(path)
+    with cache:
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS metrics ("
+            "vm_id TEXT, ts INTEGER, avg REAL, max REAL, PRIMARY KEY (vm_id, ts))"
         )
-        
-        cpu_values = []
-        for item in metrics_data.value:
-            for timeseries in item.timeseries:
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS inventory ("
+            "subscription_id TEXT PRIMARY KEY, fetched_at REAL, vms TEXT)"
+        )
+    return cache
+
+
+def load_cached_inventory(cache, subscription_id):
+    """
+    Get the cached VM list for a subscription.
+    Returns None if there is no entry or it is older than INVENTORY_CACHE_TTL.
+    """
+    row = cache.execute(
+        "SELECT fetched_at, vms FROM inventory WHERE subscription_id = ?", (subscription_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    fetched_at, vms = row
+    if datetime.now(timezone.utc).timestamp() - fetched_at > INVENTORY_CACHE_TTL.total_seconds():
+        return None
+    return json.loads(vms)
+
+
+def save_cached_inventory(cache, subscription_id, vm_list):
+    """
+    Store the VM list for a subscription in the cache.
+    """
+    with cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO inventory VALUES (?, ?, ?)",
+            (subscription_id, datetime.now(timezone.utc).timestamp(), json.dumps(vm_list))
+        )
+
+
+def load_cached_metrics(cache, start_time):
+    """
+    Get all cached CPU samples at or after start_time.
+    Returns a dict in the same shape as get_cpu_utilization_batch, with samples ordered by timestamp.
+    """
+    cpu_by_id = {}
+    rows = cache.execute(
+        "SELECT vm_id, ts, avg, max FROM metrics WHERE ts >= ? ORDER BY vm_id, ts",
+        (int(start_time.timestamp()),)
+    )
+    for vm_id, ts, avg, max_ in rows:
+        cpu_values = cpu_by_id.setdefault(vm_id, {"timestamp": [], "average": [], "maximum": []})
+        cpu_values["timestamp"].append(ts)
+        cpu_values["average"].append(avg)
+        cpu_values["maximum"].append(max_)
+    return cpu_by_id
+
+
+def save_cached_metrics(cache, cpu_by_id, start_time, end_time):
+    """
+    Store CPU samples for completed intervals in the cache and drop samples older than start_time.
+    An interval that ended less than METRICS_INGESTION_DELAY before end_time may still be missing
+    late-ingested data, so, like the interval containing end_time, it is not cached.
+    """
+    step = int(METRICS_GRANULARITY.total_seconds())
+    end_ts = int((end_time - METRICS_INGESTION_DELAY).timestamp())
+    rows = [
+        (vm_id, ts, avg, max_)
+        for vm_id, cpu_values in cpu_by_id.items()
+        for ts, avg, max_ in zip(cpu_values["timestamp"], cpu_values["average"], cpu_values["maximum"])
+        if ts + step <= end_ts
+    ]
+    with cache:
+        cache.executemany("INSERT OR IGNORE INTO metrics VALUES (?, ?, ?, ?)", rows)
+        cache.execute("DELETE FROM metrics WHERE ts < ?", (int(start_time.timestamp()),))
+
+
+def floor_to_granularity(timestamp):
+    """
+    Round a timezone-aware datetime down to the start of its METRICS_GRANULARITY interval.
+    """
+    step = int(METRICS_GRANULARITY.total_seconds())
+    return datetime.fromtimestamp(int(timestamp.timestamp()) // step * step, tz=timezone.utc)
+
+
+def create_metrics_client(region, credential):
+    """
+    Create the metrics client for a region.
+    Each regional client keeps its own connection pool, so every batch sent to that
+    endpoint reuses the same kept-alive connections.
+    """
+    return MetricsClient(
+        METRICS_ENDPOINT.format(region=region),
+        credential,
+        retry_policy=JitteredRetryPolicy(**RETRY_SETTINGS)
+    )
+
+
+async def query_cpu_batch(semaphore, metrics_client, region, vms, start_time, end_time):
+    """
+    Query CPU utilization metrics for a single batch of VMs in the same region.
+    Returns a dict mapping each lower-cased VM resource ID to a dict of "timestamp"
+    (epoch seconds), "average" and "maximum" CPU value lists.
+    """
+    try:
+        async with semaphore:
+            logger.debug("Retrieving CPU metrics for %d VMs in %s", len(vms), region)
+            results = await metrics_client.query_resources(
+                resource_ids=[vm['id'] for vm in vms],
+                metric_namespace="Microsoft.Compute/virtualMachines",
+                metric_names=["Percentage CPU"],
+                timespan=(start_time, end_time),
+                granularity=METRICS_GRANULARITY,
+                aggregations=[MetricAggregationType.AVERAGE, MetricAggregationType.MAXIMUM]
+            )
+    except ClientAuthenticationError:
+        raise
+    except HttpResponseError as e:
+        logger.warning(f"Error retrieving metrics for {len(vms)} VMs in {region}: {str(e)}")
+        return {}
+    
+    cpu_by_id = {}
+    for result in results:
+        for metric in result.metrics:
+            # Metric IDs are "<resource id>/providers/Microsoft.Insights/metrics/<name>"
+            resource_id = metric.id.lower().partition("/providers/microsoft.insights/")[0]
+            cpu_values = cpu_by_id.setdefault(resource_id, {"timestamp": [], "average": [], "maximum": []})
+            for timeseries in metric.timeseries:
                 for data in timeseries.data:
                     if data.average is not None:
-                        cpu_values.append(data.average)
-        
-        logger.info(f"VM {vm['name']} CPU values: {cpu_values if cpu_values else 'No CPU data available'}")
-        return cpu_values
-    except HttpResponseError as e:
-        logger.warning(f"Error retrieving metrics for VM {vm['name']}: {str(e)}")
-        return []
+                        cpu_values["timestamp"].append(int(data.timestamp.timestamp()))
+                        cpu_values["average"].append(data.average)
+                        cpu_values["maximum"].append(data.maximum if data.maximum is not None else data.average)
+    return cpu_by_id
 
 
-def is_underutilized(cpu_data, threshold=CPU_THRESHOLD):
+async def get_cpu_utilization_batch(credential, vms, start_time, end_time, max_concurrency=DEFAULT_MAX_CONCURRENCY, cache=None):
     """
-    Determine if a VM is underutilized based on CPU metrics.
-    Returns a tuple of (is_underutilized, average_cpu).
+    Get CPU utilization metrics for multiple VMs over the specified time period.
+    Uses the Azure Monitor metrics:getBatch data-plane API, which only accepts resources
+    from a single region, so VMs are grouped by location and queried in chunks of
+    METRICS_BATCH_SIZE against the regional endpoint. Batches are issued concurrently
+    on the event loop, with at most max_concurrency requests in flight.
+    If a cache is given, samples already cached are reused and each VM is only queried
+    from the end of its cached samples onwards.
+    Returns a dict mapping each lower-cased VM resource ID to a dict of "timestamp",
+    "average" and "maximum" CPU value lists, one entry per METRICS_GRANULARITY interval.
     """
-    if not cpu_data:
-        return False, 0.0
+    cpu_by_id = load_cached_metrics(cache, start_time) if cache is not None else {}
     
-    avg_cpu = sum(cpu_data) / len(cpu_data)
-    return avg_cpu < threshold, avg_cpu
+    # Group by region and query start, so VMs with the same cached range share a batch
+    vms_by_query = defaultdict(list)
+    for vm in vms:
+        cached = cpu_by_id.get(vm['id'].lower())
+        query_start = start_time
+        if cached:
+            query_start = datetime.fromtimestamp(cached["timestamp"][-1], tz=timezone.utc) + METRICS_GRANULARITY
+        if query_start < end_time:
+            vms_by_query[(vm['location'], query_start)].append(vm)
+    
+    semaphore = asyncio.Semaphore(max_concurrency)
+    metrics_clients = {
+        region: create_metrics_client(region, credential)
+        for region, _ in vms_by_query
+    }
+    try:
+        batch_results = await asyncio.gather(*(
+            query_cpu_batch(
+                semaphore,
+                metrics_clients[region],
+                region,
+                query_vms[i:i + METRICS_BATCH_SIZE],
+                query_start,
+                end_time
+            )
+            for (region, query_start), query_vms in vms_by_query.items()
+            for i in range(0, len(query_vms), METRICS_BATCH_SIZE)
+        ))
+    finally:
+        await asyncio.gather(*(metrics_client.close() for metrics_client in metrics_clients.values()))
+    
+    for batch_cpu_by_id in batch_results:
+        if cache is not None:
+            save_cached_metrics(cache, batch_cpu_by_id, start_time, end_time)
+        for resource_id, batch_values in batch_cpu_by_id.items():
+            cpu_values = cpu_by_id.setdefault(resource_id, {"timestamp": [], "average": [], "maximum": []})
+            for key, values in batch_values.items():
+                cpu_values[key].extend(values)
+    
+    # Skip the per-VM loop entirely unless debug logging is enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        for vm in vms:
+            cpu_values = cpu_by_id.get(vm['id'].lower(), {}).get("average")
+            logger.debug("VM %s CPU values: %s", vm['name'], cpu_values or 'No CPU data available')
+    
+    return cpu_by_id
+
+
+def to_matrix(series):
+    """
+    Stack a list of variable-length value lists into a NaN-padded 2D array, one row per list.
+    """
+    n_samples = max((len(values) for values in series), default=0)
+    matrix = np.full((len(series), n_samples), np.nan)
+    for row, values in enumerate(series):
+        matrix[row, :len(values)] = values
+    return matrix
 
 
-def generate_recommendations(vm_list, credential, subscription_id):
+def find_underutilized(timestamp_series, avg_series, max_series, end_time, threshold=CPU_THRESHOLD):
+    """
+    Determine which VMs are underutilized based on CPU metrics.
+    Stacks the CPU values of all VMs into NaN-padded matrices and aggregates them in a single pass.
+    Each interval average is weighted by the part of its METRICS_GRANULARITY interval that falls
+    before end_time, so the current, partial interval doesn't count as much as a full one.
+    Returns a tuple of (underutilized_mask, average_cpu, max_cpu) arrays with one entry per VM.
+    """
+    avg_matrix = to_matrix(avg_series)
+    max_matrix = to_matrix(max_series)
+    step = METRICS_GRANULARITY.total_seconds()
+    weights = np.clip((end_time.timestamp() - to_matrix(timestamp_series)) / step, 0, 1)
+    weights = np.nan_to_num(weights)
+    
+    avg_cpu = np.nansum(avg_matrix * weights, axis=1) / weights.sum(axis=1)
+    max_cpu = np.nanmax(max_matrix, axis=1)
+    return avg_cpu < threshold, avg_cpu, max_cpu
+
+
+async def generate_recommendations(clients, vm_list, max_concurrency=DEFAULT_MAX_CONCURRENCY, cache=None, threshold=CPU_THRESHOLD):
     """
     Generate right-sizing recommendations based on CPU utilization.
-    Only analyzes running VMs.
+    Only analyzes running VMs. Recommendations are returned as a pyarrow Table
+    with RECOMMENDATIONS_SCHEMA columns.
     """
     logger.info("Analyzing VM utilization and generating recommendations...")
     
-    monitor_client = MonitorManagementClient(credential, subscription_id)
+    end_time = datetime.now(timezone.utc)
+    # Align the window to interval boundaries so cached samples line up between runs
+    start_time = floor_to_granularity(end_time - timedelta(days=DAYS_TO_ANALYZE))
     
-    end_time = datetime.utcnow()
-    start_time = end_time - timedelta(days=DAYS_TO_ANALYZE)
-    
-    recommendations = []
+    recommendations = RECOMMENDATIONS_SCHEMA.empty_table()
     vms_without_data = []
-    running_vms = [vm for vm in vm_list if vm.get("power_state") == "running"]
-    stopped_vms = [vm for vm in vm_list if vm.get("power_state") in ["stopped", "deallocated"]]
+    power_states = list(map(itemgetter("power_state"), vm_list))
+    running_vms = [vm for vm, state in zip(vm_list, power_states) if state == "running"]
+    stopped_vms = [vm for vm, state in zip(vm_list, power_states) if state in ("stopped", "deallocated")]
     
     if not running_vms:
         logger.warning("No running VMs found to analyze")
         return recommendations, vms_without_data, running_vms, stopped_vms
     
-    for count, vm in enumerate(running_vms, 1):
-        logger.info(f"Processing running VM {count}/{len(running_vms)}: {vm['name']}")
-        
-        cpu_data = get_cpu_utilization(monitor_client, vm, subscription_id, start_time, end_time)
+    logger.info(f"Retrieving CPU metrics for {len(running_vms)} running VMs")
+    cpu_by_id = await get_cpu_utilization_batch(
+        clients.credential, running_vms, start_time, end_time, max_concurrency, cache
+    )
+    
+    analyzed_vms = []
+    timestamp_series = []
+    avg_series = []
+    max_series = []
+    for vm in running_vms:
+        cpu_data = cpu_by_id.get(vm['id'].lower())
         
-        if not cpu_data:
+        if not cpu_data or not cpu_data["average"]:
             vms_without_data.append(vm['name'])
             continue
-            
-        underutilized, avg_cpu = is_underutilized(cpu_data)
         
-        if underutilized:
-            recommendations.append({
-                "VM Name": vm['name'],
-                "Resource Group": vm['resource_group'],
-                "Location": vm['location'],
-                "VM Size": vm['vm_size'],
-                "Avg CPU (%)": round(avg_cpu, 2),
-                "Recommendation": "Consider downsizing or deallocating"
-            })
+        analyzed_vms.append(vm)
+        timestamp_series.append(cpu_data["timestamp"])
+        avg_series.append(cpu_data["average"])
+        max_series.append(cpu_data["maximum"])
+    
+    if analyzed_vms:
+        underutilized, avg_cpu, max_cpu = find_underutilized(
+            timestamp_series, avg_series, max_series, end_time, threshold
+        )
+        
+        under_idx = np.where(underutilized)[0]
+        under_vms = [analyzed_vms[i] for i in under_idx]
+        recommendations = pa.table({
+            "VM Name": [vm['name'] for vm in under_vms],
+            "Resource Group": [vm['resource_group'] for vm in under_vms],
+            "Location": [vm['location'] for vm in under_vms],
+            "VM Size": [vm['vm_size'] for vm in under_vms],
+            "Avg CPU (%)": np.round(avg_cpu[under_idx], 2),
+            "Max CPU (%)": np.round(max_cpu[under_idx], 2),
+            "Recommendation": ["Consider downsizing or deallocating"] * len(under_vms)
+        }, schema=RECOMMENDATIONS_SCHEMA)
     
     if vms_without_data:
         logger.warning(f"No CPU metrics data available for {len(vms_without_data)} running VMs: {', '.join(vms_without_data)}")
         logger.warning("These VMs might not be collecting metrics. Check Azure Monitor diagnostics settings.")
     
-    logger.info(f"Found {len(recommendations)} VMs that could be optimized")
+    logger.info(f"Found {recommendations.num_rows} VMs that could be optimized")
     return recommendations, vms_without_data, running_vms, stopped_vms
 
 
+def report_stream():
+    """
+    Return the stream for human-readable output.
+    When stdout is redirected it carries only the recommendations CSV, so everything else goes to stderr.
+    """
+    return sys.stdout if sys.stdout.isatty() else sys.stderr
+
+
+def print_rows(rows, file):
+    """
+    Print a list of dicts to file as a grid table when the output is small and interactive.
+    Otherwise write it as CSV, which streams rows without measuring every column first.
+    """
+    if len(rows) <= MAX_TABLE_ROWS and file.isatty():
+        print(tabulate(rows, headers="keys", tablefmt="grid"), file=file)
+    else:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Azure VM right-sizing recommendations")
+    parser.add_argument(
+        "--subscription-id",
+        help="Subscription to analyze (default: prompt if more than one is available)"
+    )
+    parser.add_argument(
+        "--cpu-threshold",
+        type=float,
+        default=CPU_THRESHOLD,
+        help=f"Average CPU percentage below which a VM is considered underutilized (default: {CPU_THRESHOLD})"
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENCY,
+        help=f"Maximum number of concurrent metrics requests (default: {DEFAULT_MAX_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--parquet-path",
+        default=PARQUET_PATH,
+        help=f"Path of the Parquet file recommendations are written to (default: {PARQUET_PATH})"
+    )
+    parser.add_argument(
+        "--cache-path",
+        default=CACHE_PATH,
+        help=f"Path of the on-disk VM inventory and metrics cache (default: {CACHE_PATH})"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query Azure and don't read or write the on-disk cache"
+    )
+    return parser.parse_args()
+
+
+async def run_analysis(args, cache=None):
+    """
+    Run every Azure call of the analysis on one event loop.
+    A single async credential serves subscription listing, the Resource Graph query and the
+    metrics queries, and is closed once they are done.
+    Returns the VM list followed by the results of generate_recommendations,
+    or None if the subscription has no VMs.
+    """
+    async with DefaultAzureCredential() as credential:
+        await authenticate_azure(credential)
+        
+        # Get subscription ID
+        async with SubscriptionClient(
+            credential,
+            retry_policy=JitteredRetryPolicy(**RETRY_SETTINGS)
+        ) as subscription_client:
+            subscription_id = await get_subscription(subscription_client, args.subscription_id)
+        
+        # Build the clients shared by the rest of the run
+        async with ResourceGraphClient(
+            credential,
+            retry_policy=JitteredRetryPolicy(**RETRY_SETTINGS),
+            raw_response_hook=wait_for_quota
+        ) as resource_graph_client:
+            clients = AzureClients(
+                credential=credential,
+                subscription_id=subscription_id,
+                resource_graph_client=resource_graph_client
+            )
+            
+            # Get VMs
+            vm_list = await get_virtual_machines(clients, cache)
+            
+            if not vm_list:
+                logger.warning("No virtual machines found in the subscription")
+                return None
+            
+            # Generate recommendations
+            return (vm_list, *await generate_recommendations(
+                clients, vm_list, args.max_concurrency, cache, args.cpu_threshold
+            ))
+
+
 def main():
     """
     Main function to run the VM right-sizing analysis.
     """
-    logger.info("Starting Azure VM right-sizing analysis")
-    
-    # Get authentication credential
-    credential = authenticate_azure()
-    
-    # Get subscription ID (can be replaced with a parameter)
-    subscription_id = get_subscription(credential)
-    
-    # Get VMs
-    vm_list = get_virtual_machines(credential, subscription_id)
-    
-    if not vm_list:
-        logger.warning("No virtual machines found in the subscription")
-        return
+    args = parse_args()
+    cache = None if args.no_cache else open_cache(args.cache_path)
     
-    # Generate recommendations
-    recommendations, vms_without_data, running_vms, stopped_vms = generate_recommendations(vm_list, credential, subscription_id)
-    
-    # Output VM status summary
-    print("\nVM Status Summary:")
-    print(f"- Running VMs: {len(running_vms)}")
-    print(f"- Stopped/Deallocated VMs: {len(stopped_vms)}")
-    print(f"- Total VMs: {len(vm_list)}")
-    
-    # Output recommendations
-    if recommendations:
-        print("\nVM Right-Sizing Recommendations:")
-        print(tabulate(recommendations, headers="keys", tablefmt="grid"))
+    try:
+        logger.info("Starting Azure VM right-sizing analysis")
         
-        # You could also save to a file
-        # with open('vm_rightsizing_recommendations.csv', 'w') as f:
-        #     f.write(','.join(recommendations[0].keys()) + '\n')
-        #     for rec in recommendations:
-        #         f.write(','.join(str(v) for v in rec.values()) + '\n')
-    elif len(running_vms) == 0:
-        print("\nNo running VMs found in the subscription.")
-        print("To generate right-sizing recommendations, start your VMs so metrics can be collected.")
-    elif vms_without_data and len(vms_without_data) == len(running_vms):
-        print("\nNo optimization recommendations could be generated.")
-        print(f"No CPU metrics data available for any of the running VMs: {', '.join(vms_without_data)}")
-        print("\nRecommendations:")
-        print("1. Ensure Azure Monitor diagnostics settings are properly configured")
-        print("2. Check if the Azure Monitor agent is installed and running on the VMs")
-        print("3. Wait at least 24 hours after configuring monitoring for metrics to be collected")
-    elif vms_without_data:
-        print("\nPartial data available for analysis.")
-        print(f"No CPU metrics data available for {len(vms_without_data)} of {len(running_vms)} running VMs:")
-        print(', '.join(vms_without_data))
-        print("\nAll analyzed VMs are properly utilized (above the CPU threshold).")
-    else:
-        print("\nNo optimization recommendations found. All running VMs are properly utilized.")
+        results = asyncio.run(run_analysis(args, cache))
+        if results is None:
+            return
+        vm_list, recommendations, vms_without_data, running_vms, stopped_vms = results
+        
+        # Save recommendations as the machine-readable output
+        pq.write_table(recommendations, args.parquet_path, compression="zstd")
+        logger.info(f"Saved {recommendations.num_rows} recommendations to {args.parquet_path}")
+        
+        report = report_stream()
+        
+        # Output VM status summary
+        print("\nVM Status Summary:", file=report)
+        print(f"- Running VMs: {len(running_vms)}", file=report)
+        print(f"- Stopped/Deallocated VMs: {len(stopped_vms)}", file=report)
+        print(f"- Total VMs: {len(vm_list)}", file=report)
+        
+        # Output recommendations
+        if recommendations.num_rows:
+            print("\nVM Right-Sizing Recommendations:", file=report)
+            print_rows(recommendations.to_pylist(), sys.stdout)
+        elif len(running_vms) == 0:
+            print("\nNo running VMs found in the subscription.", file=report)
+            print("To generate right-sizing recommendations, start your VMs so metrics can be collected.", file=report)
+        elif vms_without_data and len(vms_without_data) == len(running_vms):
+            print("\nNo optimization recommendations could be generated.", file=report)
+            print(f"No CPU metrics data available for any of the running VMs: {', '.join(vms_without_data)}", file=report)
+            print("\nRecommendations:", file=report)
+            print("1. Ensure Azure Monitor diagnostics settings are properly configured", file=report)
+            print("2. Check if the Azure Monitor agent is installed and running on the VMs", file=report)
+            print("3. Wait at least 24 hours after configuring monitoring for metrics to be collected", file=report)
+        elif vms_without_data:
+            print("\nPartial data available for analysis.", file=report)
+            print(f"No CPU metrics data available for {len(vms_without_data)} of {len(running_vms)} running VMs:", file=report)
+            print(', '.join(vms_without_data), file=report)
+            print("\nAll analyzed VMs are properly utilized (above the CPU threshold).", file=report)
+        else:
+            print("\nNo optimization recommendations found. All running VMs are properly utilized.", file=report)
         
-    # Print stopped VM details as potential cost saving opportunity
-    if stopped_vms:
-        print("\nStopped/Deallocated VMs (potential cost optimization):")
-        stopped_vm_details = [{
-            "VM Name": vm['name'],
-            "Resource Group": vm['resource_group'],
-            "Location": vm['location'],
-            "VM Size": vm['vm_size'],
-            "Status": vm['power_state'].capitalize(),
-            "Recommendation": "Consider deleting if no longer needed"
-        } for vm in stopped_vms]
-        print(tabulate(stopped_vm_details, headers="keys", tablefmt="grid"))
+        # Print stopped VM details as potential cost saving opportunity
+        if stopped_vms:
+            print("\nStopped/Deallocated VMs (potential cost optimization):", file=report)
+            stopped_vm_details = [{
+                "VM Name": vm['name'],
+                "Resource Group": vm['resource_group'],
+                "Location": vm['location'],
+                "VM Size": vm['vm_size'],
+                "Status": vm['power_state'].capitalize(),
+                "Recommendation": "Consider deleting if no longer needed"
+            } for vm in stopped_vms]
+            print_rows(stopped_vm_details, report)
 
+    except ClientAuthenticationError as e:
+        logger.error(f"Authentication failed: {str(e)}")
+        logger.error("Please ensure you are logged in (az login) or have appropriate environment variables set")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()